@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks how long it takes to import the spawner module, as the hub does when loading its config.
+jupyterhub.spawner is imported first in each run so only the cost added by this package is measured.
+Every run happens in a fresh interpreter; no AWS credentials, network or environment variables are needed.
+"""
+import statistics
+import subprocess
+import sys
+
+RUNS = 10
+HEAVY_MODULES = ['fabric', 'paramiko', 'boto3', 'botocore']
+
+SNIPPET = '''
+import sys, time, warnings
+warnings.simplefilter('ignore')
+import jupyterhub.spawner
+t = time.perf_counter()
+import jupyterhub_aws_spawner.spawner
+elapsed = time.perf_counter() - t
+from jupyterhub_aws_spawner.models import DB
+loaded = [m for m in %r if m in sys.modules]
+print('|'.join([str(elapsed), ','.join(loaded), str(DB.database is not None)]))
+''' % (HEAVY_MODULES,)
+
+
+def measure():
+    output = subprocess.check_output([sys.executable, '-c', SNIPPET], universal_newlines=True)
+    elapsed, loaded, db_opened = output.strip().split('|')
+    return float(elapsed), [m for m in loaded.split(',') if m], db_opened == 'True'
+
+
+if __name__ == '__main__':
+    timings = []
+    for _ in range(RUNS):
+        elapsed, loaded, db_opened = measure()
+        timings.append(elapsed)
+    print("import jupyterhub_aws_spawner.spawner over %s runs:" % RUNS)
+    print("  median %.1f ms, min %.1f ms, max %.1f ms" % (statistics.median(timings) * 1000,
+                                                         min(timings) * 1000, max(timings) * 1000))
+    print("  heavy modules loaded at import: %s" % (', '.join(loaded) if loaded else 'none'))
+    print("  tracking database opened at import: %s" % db_opened)
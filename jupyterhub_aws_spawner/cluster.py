@@ -0,0 +1,94 @@
+'''
+Sharding of per-user background work (polling, culling) between several hub processes
+that share the tracking database. Each process heartbeats into the Member table and
+users are assigned to the live members by consistent hashing of their name, so a member
+joining or leaving only moves the users of its own slice of the ring.
+'''
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+
+from jupyterhub_aws_spawner.models import Member
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
+
+
+class HashRing(object):
+    """ Consistent hash ring with `replicas` virtual points per node. """
+    def __init__(self, nodes, replicas=64):
+        self.nodes = sorted(set(nodes))
+        self._points = sorted((_hash("%s#%s" % (node, i)), node) for node in self.nodes for i in range(replicas))
+        self._keys = [point for point, _ in self._points]
+
+    def node_for(self, key):
+        """ Returns the node owning `key`, or None if the ring is empty. """
+        if not self._points:
+            return None
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._points[index][1]
+
+
+class ClusterMembership(object):
+    """ This process's view of the cluster. Heartbeats are written at most every member_ttl / 3 seconds
+        and the ring is rebuilt only when the set of live members changes. """
+    def __init__(self, node_id, member_ttl=60):
+        self.node_id = node_id
+        self.member_ttl = member_ttl
+        self._last_heartbeat = None
+        self._ring = HashRing([node_id])
+        self.task = None
+
+    def start(self):
+        """ Heartbeats in the background every member_ttl / 3 seconds, so a process with nothing to poll
+            stays in the ring the other processes see. """
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                self.refresh(force=True)
+            except Exception:
+                logger.exception("Cluster heartbeat failed")
+            await asyncio.sleep(self.member_ttl / 3)
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and self._last_heartbeat is not None and now - self._last_heartbeat < self.member_ttl / 3:
+            return self._ring
+        Member.heartbeat(self.node_id)
+        self._last_heartbeat = now
+        nodes = Member.live_nodes(self.member_ttl)
+        if self.node_id not in nodes:
+            nodes.append(self.node_id)
+        if sorted(nodes) != self._ring.nodes:
+            self._ring = HashRing(nodes)
+        return self._ring
+
+    def owner(self, key):
+        return self.refresh().node_for(key)
+
+    def owns(self, key):
+        return self.owner(key) == self.node_id
+
+    def leave(self):
+        Member.leave(self.node_id)
+        self._last_heartbeat = None
+
+
+_MEMBERSHIPS = {}
+
+def get_membership(node_id, member_ttl=60):
+    """ Returns the ClusterMembership shared by every spawner of this process with the same node_id. """
+    membership = _MEMBERSHIPS.get(node_id)
+    if membership is None:
+        membership = _MEMBERSHIPS[node_id] = ClusterMembership(node_id, member_ttl)
+    membership.member_ttl = member_ttl
+    return membership
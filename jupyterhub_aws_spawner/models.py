@@ -4,12 +4,16 @@ Now further developed by Hagen Hoferichter from idalab.de
 '''
 
 import datetime
-from peewee import Model, PostgresqlDatabase, TextField, DateTimeField, IntegerField, CharField
+import os
+from peewee import Model, PostgresqlDatabase, TextField, DateTimeField, IntegerField, CharField, IntegrityError
 from playhouse.sqlite_ext import SqliteExtDatabase
 import json
 
 # To use SQLite Database
-DB = SqliteExtDatabase('/etc/jupyterhub/server_tracking.sqlite3')
+# The database is deferred: nothing is opened until the first query, see init_db()
+# WAL and a busy timeout let several hub processes share the file, see Lease and Member.
+DB_PATH = '/etc/jupyterhub/server_tracking.sqlite3'
+DB = SqliteExtDatabase(None, pragmas={'journal_mode': 'wal', 'busy_timeout': 10000})
 
 # To use MySQL DB
 # DB = MySQLDatabase(DB_NAME, host = DB_HOST , user=DB_USERNAME, passwd=DB_USERPASSWORD)
@@ -28,6 +32,23 @@ class BaseModel(Model):
     class Meta:
         database = DB
 
+
+def init_db(path=None):
+    """ Points the deferred database at `path` (DB_PATH by default), connects and creates the tables.
+        Safe to call repeatedly; only the first call does any work. Without a `path` the database already
+        in use is kept; asking for a different path once it is bound raises ValueError. """
+    if DB.database is not None:
+        if path is not None and os.path.abspath(path) != os.path.abspath(DB.database):
+            raise ValueError("Tracking database is already open at %s, cannot switch to %s. "
+                             "Call init_db() with the configured path before any other database access."
+                             % (DB.database, path))
+        return DB
+    DB.init(path or DB_PATH)
+    DB.connect(reuse_if_open=True)
+    DB.create_tables([Server, Lease, Member, SpawnEvent, Prediction], safe=True)
+    return DB
+
+
 class Server(BaseModel):
     server_id = CharField(unique=True)
     created_at = DateTimeField(default=datetime.datetime.now)
@@ -38,20 +59,158 @@ class Server(BaseModel):
 
     @classmethod
     def new_server(cls, server_id, user_id, ebs_volume_id, iam_role='', s3_bucket=''):
-        cls.create(server_id=server_id, user_id=user_id, ebs_volume_id=ebs_volume_id)
+        init_db()
+        return cls.create(server_id=server_id, user_id=user_id, ebs_volume_id=ebs_volume_id)
 
     @classmethod
     def get_server(cls, user_id):
+        init_db()
         return cls.get(user_id=user_id)
 
     @classmethod
     def get_server_count(cls):
+        init_db()
         return cls.select().count()
 
     @classmethod
     def remove_server(cls, server_id):
+        init_db()
         cls.delete().where(cls.server_id == server_id).execute()
-        
 
-DB.connect()
-Server.create_table(True)
+
+class Lease(BaseModel):
+    """ An expiring lock on a named resource, e.g. a user's server stack, shared by all hub processes using the DB.
+        Every change is a single conditional statement so no two processes can hold the same lease. """
+    name = CharField(unique=True)
+    owner = CharField()
+    operation = CharField(default='')
+    expires_at = DateTimeField()
+
+    @classmethod
+    def acquire(cls, name, owner, ttl, operation=''):
+        """ Takes (or renews) the lease `name` for `ttl` seconds. Returns False if another owner holds it. """
+        init_db()
+        now = datetime.datetime.utcnow()
+        expires_at = now + datetime.timedelta(seconds=ttl)
+        taken = (cls.update(owner=owner, operation=operation, expires_at=expires_at)
+                    .where((cls.name == name) & ((cls.owner == owner) | (cls.expires_at < now)))
+                    .execute())
+        if taken:
+            return True
+        try:
+            cls.create(name=name, owner=owner, operation=operation, expires_at=expires_at)
+            return True
+        except IntegrityError:
+            # Held by someone else
+            return False
+
+    @classmethod
+    def release(cls, name, owner):
+        init_db()
+        cls.delete().where((cls.name == name) & (cls.owner == owner)).execute()
+
+    @classmethod
+    def holder(cls, name):
+        """ Returns the current, unexpired Lease for `name`, or None """
+        init_db()
+        return (cls.select()
+                   .where((cls.name == name) & (cls.expires_at >= datetime.datetime.utcnow()))
+                   .first())
+
+
+class Member(BaseModel):
+    """ A hub process taking part in sharded polling and culling. Members that stop heartbeating drop out. """
+    node_id = CharField(unique=True)
+    heartbeat_at = DateTimeField()
+
+    @classmethod
+    def heartbeat(cls, node_id):
+        init_db()
+        now = datetime.datetime.utcnow()
+        if cls.update(heartbeat_at=now).where(cls.node_id == node_id).execute():
+            return
+        try:
+            cls.create(node_id=node_id, heartbeat_at=now)
+        except IntegrityError:
+            cls.update(heartbeat_at=now).where(cls.node_id == node_id).execute()
+
+    @classmethod
+    def live_nodes(cls, ttl):
+        init_db()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+        return sorted(m.node_id for m in cls.select().where(cls.heartbeat_at >= cutoff))
+
+    @classmethod
+    def leave(cls, node_id):
+        init_db()
+        cls.delete().where(cls.node_id == node_id).execute()
+
+
+class SpawnEvent(BaseModel):
+    """ When a user's server was started or stopped, the history the pre-spawner predicts logins from. """
+    user_id = CharField(index=True)
+    event = CharField() # 'start' or 'stop'
+    instance_type = CharField(default='')
+    at = DateTimeField(default=datetime.datetime.utcnow, index=True)
+
+    @classmethod
+    def record(cls, user_id, event, instance_type=''):
+        init_db()
+        return cls.create(user_id=user_id, event=event, instance_type=instance_type or '')
+
+    @classmethod
+    def starts_since(cls, since):
+        """ Returns a dict of user_id to the sorted start times since `since` """
+        init_db()
+        starts = {}
+        query = (cls.select(cls.user_id, cls.at)
+                    .where((cls.event == 'start') & (cls.at >= since))
+                    .order_by(cls.at))
+        for row in query:
+            starts.setdefault(row.user_id, []).append(row.at)
+        return starts
+
+    @classmethod
+    def last_event(cls, user_id):
+        init_db()
+        return cls.select().where(cls.user_id == user_id).order_by(cls.at.desc(), cls.id.desc()).first()
+
+    @classmethod
+    def last_instance_type(cls, user_id):
+        init_db()
+        event = (cls.select()
+                    .where((cls.user_id == user_id) & (cls.event == 'start') & (cls.instance_type != ''))
+                    .order_by(cls.at.desc(), cls.id.desc())
+                    .first())
+        return event.instance_type if event else ''
+
+    @classmethod
+    def prune(cls, before):
+        """ Deletes the events older than `before`, which no prediction looks at any more. """
+        init_db()
+        return cls.delete().where(cls.at < before).execute()
+
+
+class Prediction(BaseModel):
+    """ A worker started ahead of a predicted login. Deleted when the user claims it or when it is culled. """
+    user_id = CharField(unique=True)
+    action = CharField() # 'created' for a new stack, 'resumed' for a stopped instance that was started
+    instance_type = CharField(default='')
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+    expires_at = DateTimeField()
+
+    @classmethod
+    def claim(cls, user_id):
+        """ Removes the prediction for `user_id`, returning True if there was one. """
+        init_db()
+        return bool(cls.delete().where(cls.user_id == user_id).execute())
+
+    @classmethod
+    def expired(cls, now=None):
+        init_db()
+        return list(cls.select().where(cls.expires_at < (now or datetime.datetime.utcnow())))
+
+    @classmethod
+    def count(cls):
+        init_db()
+        return cls.select().count()
@@ -0,0 +1,162 @@
+'''
+Predictive pre-spawning: users who log in at regular times (course slots, stand-ups) get their
+worker started shortly before they are expected, so their login finds it already running.
+Predictions come from the start times recorded in SpawnEvent, and every pre-spawned worker is
+tracked in Prediction until the user claims it by logging in or it is culled unclaimed.
+'''
+
+import asyncio
+import bisect
+import datetime
+import logging
+
+from jupyterhub_aws_spawner.models import Lease, SpawnEvent, Prediction
+from jupyterhub_aws_spawner.cluster import get_membership
+
+logger = logging.getLogger(__name__)
+
+
+def predict_login(starts, now, lead, window, history_days, min_days, min_weeks):
+    """ Returns True if a user with the sorted start times `starts` is expected to log in between now + lead and
+        now + lead + window: they started a server in that time of day on at least `min_days` of the last
+        `history_days` days, or in that time of the week in at least `min_weeks` weeks. """
+    begin = now + lead
+    daily = weekly = 0
+    for days in range(1, history_days + 1):
+        low = begin - datetime.timedelta(days=days)
+        i = bisect.bisect_left(starts, low)
+        if i < len(starts) and starts[i] < low + window:
+            daily += 1
+            if days % 7 == 0:
+                weekly += 1
+    return daily >= min_days or weekly >= min_weeks
+
+
+class PreSpawner(object):
+    """ Periodically predicts logins and starts (or resumes) workers for them, within the cost cap of
+        `max_workers` unclaimed workers. `stacks` is a WorkerStacks (or anything with its async prespawn and
+        cull_prespawned methods); times are in seconds. With several hub processes each one only handles
+        the users of its own shard. A user whose pre-spawn fails is skipped for a while, twice as long after
+        each consecutive failure, so one broken user cannot hold up the others. """
+    def __init__(self, stacks, node_id, lease_ttl=3600, member_ttl=60, interval=300, lead_time=600, window=1800,
+                 history_days=28, min_days=10, min_weeks=3, max_workers=5, claim_grace=1800):
+        self.stacks = stacks
+        self.node_id = node_id
+        self.lease_ttl = lease_ttl
+        self.member_ttl = member_ttl
+        self.interval = interval
+        self.lead_time = lead_time
+        self.window = window
+        self.history_days = history_days
+        self.min_days = min_days
+        self.min_weeks = min_weeks
+        self.max_workers = max_workers
+        self.claim_grace = claim_grace
+        self.failures = {} # user_id -> (consecutive failures, no retry before)
+        self.task = None
+
+    @classmethod
+    def from_config(cls, spawner):
+        """ Builds a PreSpawner from the configuration of `spawner`, any InstanceSpawner of this hub process. """
+        return cls(spawner.worker_stacks(), spawner.node_id, spawner.lease_ttl, spawner.member_ttl,
+                   spawner.prespawn_interval, spawner.prespawn_lead_time, spawner.prespawn_window,
+                   spawner.prespawn_history_days, spawner.prespawn_min_days, spawner.prespawn_min_weeks,
+                   spawner.prespawn_max_workers, spawner.prespawn_claim_grace)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Pre-spawn pass failed")
+            await asyncio.sleep(self.interval)
+
+    async def tick(self, now=None):
+        """ One pass: cull expired predictions, then pre-spawn for the users expected next. """
+        now = now or datetime.datetime.utcnow()
+        lead = datetime.timedelta(seconds=self.lead_time)
+        window = datetime.timedelta(seconds=self.window)
+        membership = get_membership(self.node_id, self.member_ttl)
+
+        for prediction in Prediction.expired(now):
+            if membership.owns(prediction.user_id):
+                try:
+                    await self.cull(prediction)
+                except Exception:
+                    # The prediction is kept, so the cull is tried again on the next pass
+                    logger.exception("Culling the pre-spawned worker of %s failed" % prediction.user_id)
+
+        since = now - datetime.timedelta(days=self.history_days)
+        SpawnEvent.prune(since)
+        for user_id, starts in sorted(SpawnEvent.starts_since(since).items()):
+            if Prediction.count() >= self.max_workers:
+                logger.info("Pre-spawn cap of %s workers reached" % self.max_workers)
+                break
+            if not membership.owns(user_id):
+                continue
+            if not predict_login(starts, now, lead, window, self.history_days, self.min_days, self.min_weeks):
+                continue
+            last = SpawnEvent.last_event(user_id)
+            if last is not None and last.event == 'start':
+                # Already running
+                continue
+            if Prediction.get_or_none(Prediction.user_id == user_id) is not None:
+                continue
+            count, retry_at = self.failures.get(user_id, (0, None))
+            if retry_at is not None and now < retry_at:
+                continue
+            expires_at = now + lead + window + datetime.timedelta(seconds=self.claim_grace)
+            try:
+                await self.prespawn(user_id, expires_at)
+            except Exception:
+                count += 1
+                delay = min(self.interval * 2 ** count, 86400)
+                logger.exception("Pre-spawning for %s failed (%s in a row), skipping them for %s seconds"
+                                 % (user_id, count, delay))
+                self.failures[user_id] = (count, now + datetime.timedelta(seconds=delay))
+            else:
+                self.failures.pop(user_id, None)
+
+    async def prespawn(self, user_id, expires_at):
+        stackname = f'{user_id}-server'
+        if not Lease.acquire(stackname, self.node_id, self.lease_ttl, 'prespawn'):
+            return
+        try:
+            instance_type = SpawnEvent.last_instance_type(user_id)
+            action = await self.stacks.prespawn(user_id, instance_type)
+            if action:
+                logger.info("Pre-spawned worker for %s (%s, %s)" % (user_id, action, instance_type or 'default type'))
+                Prediction.create(user_id=user_id, action=action, instance_type=instance_type, expires_at=expires_at)
+        finally:
+            Lease.release(stackname, self.node_id)
+
+    async def cull(self, prediction):
+        stackname = f'{prediction.user_id}-server'
+        if not Lease.acquire(stackname, self.node_id, self.lease_ttl, 'cull'):
+            # The user is logging in right now, or another process is culling
+            return
+        try:
+            # A login claims the prediction while holding the lease, so it cannot be claimed while we cull.
+            # The row is only removed once the worker is gone, so a failed cull is tried again.
+            if Prediction.get_or_none(Prediction.user_id == prediction.user_id) is not None:
+                logger.info("Culling unclaimed pre-spawned worker for %s" % prediction.user_id)
+                await self.stacks.cull_prespawned(prediction.user_id, prediction.action)
+                Prediction.claim(prediction.user_id)
+                SpawnEvent.record(prediction.user_id, 'stop')
+        finally:
+            Lease.release(stackname, self.node_id)
+
+
+_PRESPAWNER = None
+
+def ensure_prespawner(spawner):
+    """ Starts this process's PreSpawner on first call, configured from `spawner`. """
+    global _PRESPAWNER
+    if _PRESPAWNER is None:
+        _PRESPAWNER = PreSpawner.from_config(spawner)
+    _PRESPAWNER.start()
+    return _PRESPAWNER
@@ -6,49 +6,41 @@ Now further developed by Hagen Hoferichter from idalab.de
 import json
 import logging
 import socket
-import boto3
 import os
-from fabric.api import env, sudo as _sudo, run as _run
-from fabric.context_managers import settings
-from fabric.exceptions import NetworkError
-from paramiko.ssh_exception import SSHException, ChannelException
-from botocore.exceptions import ClientError, WaiterError
+import time
+import hashlib
+import base64
+import uuid
 from datetime import datetime
+from functools import lru_cache
+from urllib.parse import urlparse, unquote
 from tornado import web
+from traitlets import Unicode, Integer, Bool, default
 from jupyterhub.spawner import Spawner
 import asyncio
 #from concurrent.futures import ThreadPoolExecutor
 
-
-from jupyterhub_aws_spawner.models import Server
+# Fabric, Paramiko and boto3 are imported on first use (see _remote_commands, _retryable_errors and
+# aws_client) so that loading the hub config does not pay for them.
+from jupyterhub_aws_spawner.models import Server, Lease, SpawnEvent, Prediction, init_db, DB_PATH
+from jupyterhub_aws_spawner.cluster import get_membership
+from jupyterhub_aws_spawner.prespawn import ensure_prespawner
 from jupyterhub_aws_spawner.aws_ressources import AWS_INSTANCE_TYPES
 
 
-def get_local_ip_address():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(("8.8.8.8", 80))
-    ip_address = s.getsockname()[0]
-    s.close()
-    return ip_address
-
 class ResourceNotFound(Exception):
     pass
 
 class ServerNotFound(ResourceNotFound):
-    print('Server not found in database')
+    """ Server not found in database """
     pass
 
 class VolumeNotFound(ResourceNotFound):
-    print('Volume not found in database')
+    """ Volume not found in database """
     pass
 
 
-SERVER_TEMPLATE_URL = os.environ['ServerTemplateUrl']
-SERVER_KEY_NAME = os.environ['ServerKeyName']
-PARENT_STACK = os.environ['ParentStack']
-
 LONG_RETRY_COUNT = 120
-HUB_MANAGER_IP_ADDRESS = get_local_ip_address()
 NOTEBOOK_SERVER_PORT = 80
 WORKER_USERNAME  = "jovyan"
 WORKER_IP = None
@@ -66,7 +58,6 @@ SERVER_PARAMS =   {
   "AVAILABILITY_ZONE": "a", 
   "WORKER_SERVER_NAME": "", 
   "USER_HOME_EBS_SIZE": "", 
-  "KEY_NAME": SERVER_KEY_NAME, 
   "WORKER_AMI": "", 
   "WORKER_SECURITY_GROUPS": [""], 
   "JUPYTER_NOTEBOOK_TIMEOUT": 3600, 
@@ -82,66 +73,641 @@ WORKER_TAGS = [ #These tags are set on every server created by the spawner
 #thread_pool = ThreadPoolExecutor(100)
 
 #Logging settings
-#logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 #logging.basicConfig(level=logging.INFO)
 
 
-#Global Fabric config
 class RemoteCmdExecutionError(Exception): pass
-env.abort_exception = RemoteCmdExecutionError
-env.abort_on_prompts = True
-
-FABRIC_DEFAULTS = {"user":SERVER_PARAMS["WORKER_USERNAME"],
-                   "key_filename":"/home/%s/.ssh/%s" % (SERVER_PARAMS["SERVER_USERNAME"], SERVER_PARAMS["KEY_NAME"])}
 
 FABRIC_QUIET = True
 #FABRIC_QUIET = False
 # Make Fabric only print output of commands when logging level is greater than warning.
 
+_REMOTE_COMMANDS = None
+
+def _remote_commands():
+    """ Returns the (run, sudo) pair used to execute commands on the workers, importing it on first use.
+        With AWS_SPAWNER_TEST set these are the bastion helpers from ssh_run_debug, otherwise Fabric's,
+        in which case the global Fabric config is applied here. """
+    global _REMOTE_COMMANDS
+    if _REMOTE_COMMANDS is None:
+        if os.environ.get('AWS_SPAWNER_TEST'):
+            from ssh_run_debug import _run, _sudo
+        else:
+            from fabric.api import env, sudo as _sudo, run as _run
+            #Global Fabric config
+            env.abort_exception = RemoteCmdExecutionError
+            env.abort_on_prompts = True
+        _REMOTE_COMMANDS = (_run, _sudo)
+    return _REMOTE_COMMANDS
+
+def fabric_settings(**kwargs):
+    """ Lazily imported fabric.context_managers.settings """
+    from fabric.context_managers import settings
+    return settings(**kwargs)
+
+def _on_host(function, host_settings):
+    """ Wraps a remote command so each call applies `host_settings` (Fabric env keys such as host_string) and restores
+        them before returning. Fabric's env is process-global, so it must never stay changed across an await. """
+    if not host_settings:
+        return function
+    def call(*args, **kwargs):
+        if os.environ.get('AWS_SPAWNER_TEST'):
+            # The bastion helpers read the worker from the environment instead
+            os.environ['AWS_SPAWNER_WORKER_IP'] = host_settings.get('host_string', '')
+            return function(*args, **kwargs)
+        with fabric_settings(**host_settings):
+            return function(*args, **kwargs)
+    call.__name__ = function.__name__
+    return call
+
 if os.environ.get('AWS_SPAWNER_TEST'):
-    from ssh_run_debug import _run, _sudo
-    async def run(cmd, *args, **kwargs):
-       ret = await retry(_run, cmd , sudo = False, *args, **kwargs)
+    async def run(cmd, *args, host_settings=None, **kwargs):
+       _run, _sudo = _remote_commands()
+       ret = await retry(_on_host(_run, host_settings), cmd , sudo = False, *args, **kwargs)
        return ret
     
-    async def sudo(cmd, *args, **kwargs):
-        ret = await retry(_sudo, cmd, *args, **kwargs)
+    async def sudo(cmd, *args, host_settings=None, **kwargs):
+        _run, _sudo = _remote_commands()
+        ret = await retry(_on_host(_sudo, host_settings), cmd, *args, **kwargs)
         return ret
 else:
-    from fabric.api import sudo as _sudo, run as _run
-    async def sudo(*args, **kwargs):
-        ret = await retry(_sudo, *args, **kwargs, quiet=FABRIC_QUIET)
+    async def sudo(*args, host_settings=None, **kwargs):
+        _run, _sudo = _remote_commands()
+        ret = await retry(_on_host(_sudo, host_settings), *args, **kwargs, quiet=FABRIC_QUIET)
         return ret
     
-    async def run(*args, **kwargs):
-        ret = await retry(_run, *args, **kwargs, quiet=FABRIC_QUIET)
+    async def run(*args, host_settings=None, **kwargs):
+        _run, _sudo = _remote_commands()
+        ret = await retry(_on_host(_run, host_settings), *args, **kwargs, quiet=FABRIC_QUIET)
         return ret
 
 
+@lru_cache(maxsize=None)
+def aws_client(service, region_name):
+    """ Returns a boto3 client for `service`, built on first use and shared afterwards. """
+    import boto3
+    return boto3.client(service, region_name=region_name)
+
+@lru_cache(maxsize=None)
+def aws_resource(service, region_name):
+    """ Returns a boto3 resource for `service`, built on first use and shared afterwards. """
+    import boto3
+    return boto3.resource(service, region_name=region_name)
+
+@lru_cache(maxsize=None)
+def _retryable_errors():
+    """ The exceptions retry() swallows. Only evaluated once a call has actually failed. """
+    from fabric.exceptions import NetworkError
+    from paramiko.ssh_exception import SSHException, ChannelException
+    from botocore.exceptions import ClientError, WaiterError
+    #EOFError can occur in fabric
+    return (ClientError, WaiterError, NetworkError, RemoteCmdExecutionError, EOFError, SSHException, ChannelException)
+
     
 async def retry(function, *args, **kwargs):
     """ Retries a function up to max_retries, waiting `timeout` seconds between tries.
         This function is designed to retry both boto3 and fabric calls.  In the
         case of boto3, it is necessary because sometimes aws calls return too
-        early and a resource needed by the next call is not yet available. """
-    logger.info("Entering retry with function %s with args %s and kwargs %s" % (function.__name__, args, kwargs))
+        early and a resource needed by the next call is not yet available.
+        Pass `log_args` to log that description instead of the actual arguments, e.g. for commands that may
+        contain secrets. """
     max_retries = kwargs.pop("max_retries", 10)
     timeout = kwargs.pop("timeout", 1)            
+    log_args = kwargs.pop("log_args", None)
+    if log_args is None:
+        log_args = "args %s and kwargs %s" % (args, kwargs)
+    logger.info("Entering retry with function %s with %s" % (function.__name__, log_args))
     for attempt in range(max_retries):
         try:
 #            ret = thread_pool.submit(function, *args, **kwargs)
             ret = function(*args, **kwargs)
             return ret
-        except (ClientError, WaiterError, NetworkError, RemoteCmdExecutionError, EOFError, SSHException, ChannelException) as e:
-            #EOFError can occur in fabric
-            logger.error("Failure in %s with args %s and kwargs %s" % (function.__name__, args, kwargs))
+        except _retryable_errors() as e:
+            logger.error("Failure in %s with %s" % (function.__name__, log_args))
             logger.info("retrying %s, (~%s seconds elapsed)" % (function.__name__, attempt * 3))
-            asyncio.sleep(timeout)
+            await asyncio.sleep(timeout)
     else:
-        logger.error("Failure in %s with args %s and kwargs %s" % (function.__name__, args, kwargs))
-        asyncio.sleep(0.1) #this line exists to allow the logger time to print
+        logger.error("Failure in %s with %s" % (function.__name__, log_args))
+        await asyncio.sleep(0.1) #this line exists to allow the logger time to print
         return ("RETRY_FAILED")
 
+
+#########################################################################################################
+### server template cache ###
+
+TEMPLATE_BODY_MAX_SIZE = 51200 # CloudFormation's limit for TemplateBody, larger templates are passed by URL
+_TEMPLATE_CACHE = {}
+
+def parse_s3_url(url):
+    """ Returns (bucket, key) for the path-style and virtual-hosted S3 URLs CloudFormation accepts as
+        TemplateURL, or None if `url` is not one of them. """
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    path = parsed.path.lstrip('/')
+    if not host.endswith('.amazonaws.com') or not path:
+        return None
+    labels = host[:-len('.amazonaws.com')].split('.')
+    s3_labels = [i for i, label in enumerate(labels) if label == 's3' or label.startswith('s3-')]
+    if not s3_labels:
+        return None
+    if s3_labels[0] == 0:
+        # https://s3.<region>.amazonaws.com/<bucket>/<key>
+        bucket, _, key = path.partition('/')
+    else:
+        # https://<bucket>.s3.<region>.amazonaws.com/<key>
+        bucket, key = '.'.join(labels[:s3_labels[0]]), path
+    if not bucket or not key:
+        return None
+    return bucket, unquote(key)
+
+
+class ServerTemplate(object):
+    """ The worker stack template, fetched from S3 and validated by CloudFormation once, then reused
+        for every stack until its S3 object changes. """
+    def __init__(self, url, etag, body, parameters):
+        self.url = url
+        self.etag = etag
+        self.body = body
+        self.sha256 = hashlib.sha256(body.encode('utf-8')).hexdigest() if body is not None else None
+        self.parameters = {p['ParameterKey']: p for p in parameters}
+        self.checked_at = time.monotonic()
+
+    def stack_kwargs(self):
+        """ How to hand the template to create_stack: inline if possible, so CloudFormation does not fetch it again. """
+        if self.body is not None and len(self.body.encode('utf-8')) <= TEMPLATE_BODY_MAX_SIZE:
+            return {"TemplateBody": self.body}
+        return {"TemplateURL": self.url}
+
+    def check_parameters(self, parameters):
+        """ Returns a list of problems with `parameters` (create_stack's Parameters list) for this template. """
+        given = {p["ParameterKey"]: p["ParameterValue"] for p in parameters}
+        problems = ["unknown parameter %s" % key for key in given if key not in self.parameters]
+        for key, declared in self.parameters.items():
+            if "DefaultValue" not in declared and not given.get(key):
+                problems.append("missing value for parameter %s" % key)
+        return problems
+
+
+async def get_server_template(url, region, max_age):
+    """ Returns the ServerTemplate for `url`. A cached template is trusted for `max_age` seconds. After that an
+        S3 template is only fetched and validated again if its ETag and content changed; any other URL is
+        validated again by CloudFormation. """
+    if not url:
+        raise web.HTTPError(500, "No server template configured. Set c.InstanceSpawner.server_template_url "
+                                 "or the ServerTemplateUrl environment variable.")
+    cached = _TEMPLATE_CACHE.get(url)
+    if cached and time.monotonic() - cached.checked_at < max_age:
+        return cached
+    cloudformation = aws_client("cloudformation", region)
+    location = parse_s3_url(url)
+    if location is None:
+        # Not an S3 URL we can read ourselves, let CloudFormation fetch and validate it again
+        response = await retry(cloudformation.validate_template, TemplateURL=url)
+        if response == "RETRY_FAILED":
+            raise web.HTTPError(503, "Could not validate server template %s" % url)
+        template = ServerTemplate(url, None, None, response["Parameters"])
+    else:
+        bucket, key = location
+        s3 = aws_client("s3", region)
+        head = await retry(s3.head_object, Bucket=bucket, Key=key)
+        if head == "RETRY_FAILED":
+            raise web.HTTPError(503, "Could not read server template %s" % url)
+        if cached and cached.etag == head["ETag"]:
+            cached.checked_at = time.monotonic()
+            return cached
+        obj = await retry(s3.get_object, Bucket=bucket, Key=key)
+        if obj == "RETRY_FAILED":
+            raise web.HTTPError(503, "Could not read server template %s" % url)
+        body = obj["Body"].read().decode('utf-8')
+        if cached and cached.sha256 == hashlib.sha256(body.encode('utf-8')).hexdigest():
+            # Object was rewritten with identical content, no need to validate again
+            cached.etag = obj["ETag"]
+            cached.checked_at = time.monotonic()
+            return cached
+        template = ServerTemplate(url, obj["ETag"], body, [])
+        response = await retry(cloudformation.validate_template, **template.stack_kwargs())
+        if response == "RETRY_FAILED":
+            raise web.HTTPError(503, "Could not validate server template %s" % url)
+        template.parameters = {p["ParameterKey"]: p for p in response["Parameters"]}
+    _TEMPLATE_CACHE[url] = template
+    logger.info("Cached server template %s (sha256 %s)" % (url, template.sha256))
+    return template
+
+
+#########################################################################################################
+### stacks and workers ###
+
+def describe_stack(client, stackname):
+    """ Returns the description of `stackname`, or None if there is no such stack (any more). """
+    from botocore.exceptions import ClientError
+    try:
+        return client.describe_stacks(StackName=stackname)['Stacks'][0]
+    except ClientError as e:
+        if "does not exist" in str(e):
+            return None
+        raise
+
+
+async def wait_for_stack(client, stackname, on_poll=None, delay=15, max_attempts=240):
+    """ Polls `stackname` until it leaves its *_IN_PROGRESS state, sleeping on the event loop in between so other
+        users are served, and calling on_poll() before each check (e.g. to renew a lease). Returns the final stack
+        description, or None once the stack no longer exists. """
+    for attempt in range(max_attempts):
+        if on_poll is not None:
+            on_poll()
+        stack = describe_stack(client, stackname)
+        if stack is None or not stack['StackStatus'].endswith('_IN_PROGRESS'):
+            return stack
+        await asyncio.sleep(delay)
+    raise web.HTTPError(503, "Stack %s is still %s. Please try again in a few minutes" % (stackname, stack['StackStatus']))
+
+
+def stack_outputs(stack):
+    return {o['OutputKey']: o['OutputValue'] for o in stack.get('Outputs', [])}
+
+
+def stack_instance_id(client, stack, id_output):
+    """ The worker instance of `stack`, from its `id_output` output or, if the template does not declare it, its resources """
+    instance_id = stack_outputs(stack).get(id_output)
+    if not instance_id:
+        response = client.describe_stack_resources(StackName=stack['StackName'])
+        instances = [i for i in response['StackResources'] if i['ResourceType']=='AWS::EC2::Instance']
+        instance_id = instances[0]['PhysicalResourceId']
+    return instance_id
+
+
+def instance_uptime(instance):
+    """ Seconds since `instance` was launched """
+    return (datetime.utcnow() - instance.launch_time.replace(tzinfo=None)).total_seconds()
+
+
+async def ssh_connectable(ip_address_string, fabric_defaults, max_retries=1):
+    """ Runs a meaningless bash command (a comment) on the worker, up to max_retries times a second apart, and
+        returns whether SSH got through. The connection is made in an executor thread, off the event loop. """
+    loop = asyncio.get_event_loop()
+    for attempt in range(max_retries):
+        output, error = await loop.run_in_executor(
+            None, ssh_exec, ip_address_string, "# waiting for ssh to be connectable...", fabric_defaults)
+        if error is None:
+            return True
+        logger.info("SSH to %s failed (attempt %s of %s): %s" % (ip_address_string, attempt + 1, max_retries, error))
+        if attempt + 1 < max_retries:
+            await asyncio.sleep(1)
+    return False
+
+
+ADOPTABLE_STACK_STATUSES = ('CREATE_IN_PROGRESS', 'CREATE_COMPLETE', 'UPDATE_COMPLETE')
+
+
+class WorkerStacks(object):
+    """ Creates, inspects and removes the worker stacks of any user. Holds configuration only, no per-user state,
+        so background tasks such as the pre-spawner can use it without borrowing a user's spawner. """
+    def __init__(self, region, server_template_url, server_key_name, parent_stack, template_cache_ttl,
+                 validate_parameters, instance_id_output, instance_ip_output):
+        self.region = region
+        self.server_template_url = server_template_url
+        self.server_key_name = server_key_name
+        self.parent_stack = parent_stack
+        self.template_cache_ttl = template_cache_ttl
+        self.validate_parameters = validate_parameters
+        self.instance_id_output = instance_id_output
+        self.instance_ip_output = instance_ip_output
+
+    @classmethod
+    def from_config(cls, spawner):
+        return cls(spawner.region, spawner.server_template_url, spawner.server_key_name, spawner.parent_stack,
+                   spawner.template_cache_ttl, spawner.validate_parameters,
+                   spawner.instance_id_output, spawner.instance_ip_output)
+
+    def stack_parameters(self, template, user_name, instance_type):
+        """ The Parameters passed to create_stack for a user. InstanceType is only sent if the template declares it. """
+        parameters = [
+            {"ParameterKey": "User", "ParameterValue": str(user_name)},
+            {"ParameterKey": "KeyName", "ParameterValue": str(self.server_key_name)},
+            {"ParameterKey": "ParentStack", "ParameterValue": str(self.parent_stack)},
+        ]
+        if instance_type and "InstanceType" in template.parameters:
+            parameters.append({"ParameterKey": "InstanceType", "ParameterValue": instance_type})
+        return parameters
+
+    async def launch(self, user_name, instance_type):
+        """ Starts creating the server stack for `user_name` without waiting for it to finish.
+            Returns False if the stack already exists. """
+        from botocore.exceptions import ClientError
+        stackname = f'{user_name}-server'
+
+        template = await get_server_template(self.server_template_url, self.region, self.template_cache_ttl)
+        parameters = self.stack_parameters(template, user_name, instance_type)
+        if self.validate_parameters:
+            problems = template.check_parameters(parameters)
+            if instance_type and instance_type not in AWS_INSTANCE_TYPES:
+                problems.append("unknown instance type %s" % instance_type)
+            if problems:
+                raise web.HTTPError(400, "Cannot create server for %s: %s" % (user_name, ", ".join(problems)))
+
+        client = aws_client("cloudformation", self.region)
+        try:
+            client.create_stack(
+                    StackName=stackname,
+                    Parameters=parameters,
+                    **template.stack_kwargs()
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'AlreadyExistsException':
+                raise
+            return False
+        return True
+
+    async def instance(self, user_name, stack=None):
+        """ Returns (instance, private ip) of the user's finished stack. Pass `stack` if its description is
+            already at hand to save a describe_stacks call. """
+        client = aws_client("cloudformation", self.region)
+        if stack is None:
+            stack = client.describe_stacks(StackName=f'{user_name}-server')['Stacks'][0]
+        instance_id = stack_instance_id(client, stack, self.instance_id_output)
+
+        ec2 = aws_resource("ec2", self.region)
+        instance = await retry(ec2.Instance, instance_id)
+        # Reading private_ip_address would load the instance, an extra DescribeInstances call
+        ip = stack_outputs(stack).get(self.instance_ip_output) or instance.private_ip_address
+        return instance, ip
+
+    async def prespawn(self, user_name, instance_type):
+        """ Gets a worker ready for `user_name` ahead of a predicted login. Returns 'created' if a new stack was
+            started, 'resumed' if the user's stopped instance was started, or None if there was nothing to do. """
+        if await self.launch(user_name, instance_type):
+            return 'created'
+        stack = describe_stack(aws_client("cloudformation", self.region), f'{user_name}-server')
+        if stack is None or stack['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+            return None
+        instance, ip = await self.instance(user_name, stack)
+        await retry(instance.load)
+        if instance.state["Name"] == "stopped":
+            await retry(instance.start)
+            return 'resumed'
+        return None
+
+    async def cull_prespawned(self, user_name, action):
+        """ Undoes an unclaimed pre-spawn: deletes a stack the pre-spawner created, or stops an instance it resumed. """
+        client = aws_client("cloudformation", self.region)
+        if action == 'created':
+            client.delete_stack(StackName=f'{user_name}-server')
+        elif action == 'resumed':
+            stack = describe_stack(client, f'{user_name}-server')
+            if stack is None:
+                # Already gone, nothing left to stop
+                return
+            instance, ip = await self.instance(user_name, stack)
+            await retry(instance.stop)
+
+
+class ShardMonitor(object):
+    """ Background culler for the users in this hub process's shard, and the only place hung workers are culled.
+        Every `interval` seconds it walks all worker stacks of the cluster (found by their ParentStack parameter),
+        not only the users this hub serves, and deletes the stacks of owned workers that have been up for over
+        three minutes but stopped answering SSH. AWS calls and SSH probes run in executor threads, at most
+        `parallelism` workers at a time. With `record_events` a culled worker is recorded as a 'stop' for the
+        pre-spawner. Built from a snapshot of the spawner config, so it is independent of any one user's spawner. """
+    def __init__(self, node_id, region, parent_stack, fabric_defaults, instance_id_output,
+                 lease_ttl, member_ttl, interval, parallelism=10, record_events=False):
+        self.node_id = node_id
+        self.region = region
+        self.parent_stack = parent_stack
+        self.fabric_defaults = fabric_defaults
+        self.instance_id_output = instance_id_output
+        self.lease_ttl = lease_ttl
+        self.member_ttl = member_ttl
+        self.interval = interval
+        self.parallelism = parallelism
+        self.record_events = record_events
+        self.task = None
+
+    @classmethod
+    def from_config(cls, spawner):
+        return cls(spawner.node_id, spawner.region, spawner.parent_stack, dict(spawner.fabric_defaults),
+                   spawner.instance_id_output, spawner.lease_ttl, spawner.member_ttl, spawner.shard_monitor_interval,
+                   spawner.batch_parallelism, spawner.prespawn_enabled)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Shard monitor pass failed")
+            await asyncio.sleep(self.interval)
+
+    def worker_stacks(self):
+        """ Returns a dict of user name to the description of their finished worker stack """
+        client = aws_client("cloudformation", self.region)
+        stacks = {}
+        for page in client.get_paginator('describe_stacks').paginate():
+            for stack in page['Stacks']:
+                if stack['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+                    continue
+                parameters = {p['ParameterKey']: p.get('ParameterValue') for p in stack.get('Parameters', [])}
+                if parameters.get('ParentStack') != self.parent_stack or not parameters.get('User'):
+                    continue
+                if stack['StackName'] == f"{parameters['User']}-server":
+                    stacks[parameters['User']] = stack
+        return stacks
+
+    async def tick(self):
+        loop = asyncio.get_event_loop()
+        membership = get_membership(self.node_id, self.member_ttl)
+        stacks = await loop.run_in_executor(None, self.worker_stacks)
+        semaphore = asyncio.Semaphore(self.parallelism)
+
+        async def check(user_name, stack):
+            async with semaphore:
+                try:
+                    await self.check_worker(user_name, stack)
+                except Exception:
+                    logger.exception("Checking the worker of %s failed" % user_name)
+
+        await asyncio.gather(*[check(user_name, stack) for user_name, stack in sorted(stacks.items())
+                               if membership.owns(user_name)])
+
+    async def check_worker(self, user_name, stack):
+        loop = asyncio.get_event_loop()
+        client = aws_client("cloudformation", self.region)
+        instance_id = await loop.run_in_executor(None, stack_instance_id, client, stack, self.instance_id_output)
+        instance = aws_resource("ec2", self.region).Instance(instance_id)
+        await loop.run_in_executor(None, instance.load)
+        if instance.state['Name'] != 'running' or instance_uptime(instance) <= 180:
+            return
+        if await ssh_connectable(instance.private_ip_address, self.fabric_defaults, max_retries=5):
+            return
+        stackname = stack['StackName']
+        if not Lease.acquire(stackname, self.node_id, self.lease_ttl, 'cull'):
+            # Being created or deleted right now
+            return
+        try:
+            logger.info("Worker %s of stack %s is not answering SSH, deleting the stack" % (instance.id, stackname))
+            client.delete_stack(StackName=stackname)
+            if self.record_events:
+                SpawnEvent.record(user_name, 'stop')
+        finally:
+            Lease.release(stackname, self.node_id)
+
+
+_SHARD_MONITOR = None
+
+def ensure_shard_monitor(spawner):
+    """ Starts this process's ShardMonitor on first call, from `spawner`'s config. """
+    global _SHARD_MONITOR
+    if _SHARD_MONITOR is None:
+        _SHARD_MONITOR = ShardMonitor.from_config(spawner)
+    _SHARD_MONITOR.start()
+    return _SHARD_MONITOR
+
+
+#########################################################################################################
+### batched remote execution ###
+
+class StepResult(object):
+    """ Output and exit code of one command of a batch. exit_code is None if the step never ran. """
+    def __init__(self, command, exit_code=None, output=''):
+        self.command = command
+        self.exit_code = exit_code
+        self.output = output
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+    def __repr__(self):
+        return "StepResult(%r, exit_code=%r)" % (self.command, self.exit_code)
+
+
+class BatchResult(object):
+    """ Results of a batch on one worker. `error` is set if the batch could not be run at all. """
+    def __init__(self, host, steps, error=None):
+        self.host = host
+        self.steps = steps
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and all(step.ok for step in self.steps)
+
+    def __repr__(self):
+        return "BatchResult(%r, steps=%r, error=%r)" % (self.host, self.steps, self.error)
+
+
+def build_batch_script(commands, stop_on_error=True):
+    """ Returns (marker, script): a bash script running `commands` in order, printing `marker` lines around each
+        step's output with its exit code. The script itself always exits 0 so failed steps are reported, not retried. """
+    marker = "__AWS_SPAWNER_STEP_%s__" % uuid.uuid4().hex
+    lines = []
+    for i, command in enumerate(commands):
+        lines.append("printf '\\n%s %d START\\n'" % (marker, i))
+        # No step may read the script or wait on the terminal, so stdin is /dev/null
+        lines.append("( %s\n) </dev/null 2>&1" % command)
+        lines.append("rc=$?")
+        lines.append("printf '\\n%s %d EXIT %%d\\n' $rc" % (marker, i))
+        if stop_on_error:
+            lines.append("[ $rc -eq 0 ] || exit 0")
+    lines.append("exit 0")
+    return marker, "\n".join(lines) + "\n"
+
+
+def batch_command(script):
+    """ The single shell command shipping `script` to a worker. Base64 avoids any quoting by Fabric or the remote shell.
+        The script is passed as an argument rather than on stdin, so steps reading stdin cannot consume it. """
+    encoded = base64.b64encode(script.encode('utf-8')).decode('ascii')
+    return 'bash -c "$(echo %s | base64 -d)"' % encoded
+
+
+def parse_batch_output(commands, marker, output):
+    """ Splits the output of a build_batch_script script into one StepResult per command. """
+    steps = [StepResult(command) for command in commands]
+    current = None
+    buffer = []
+    for line in str(output).splitlines():
+        if not line.startswith(marker):
+            if current is not None:
+                buffer.append(line)
+            continue
+        fields = line.split()
+        if len(fields) < 3 or not fields[1].isdigit() or int(fields[1]) >= len(steps):
+            continue
+        index = int(fields[1])
+        if fields[2] == "START":
+            current, buffer = index, []
+        elif fields[2] == "EXIT" and len(fields) > 3:
+            # The script prints a newline before each marker so output without a trailing newline stays separate
+            if buffer and buffer[-1] == '':
+                buffer.pop()
+            steps[index].output = "\n".join(buffer).strip('\r')
+            steps[index].exit_code = int(fields[3])
+            current, buffer = None, []
+    return steps
+
+
+def ssh_command(command, use_sudo=False):
+    """ The command line ssh_exec sends: `command` in a bash login shell like Fabric's run and sudo, with sudo
+        never prompting for a password. """
+    import shlex
+    return "%s/bin/bash -l -c %s" % ("sudo -n " if use_sudo else "", shlex.quote(command))
+
+
+def ssh_exec(host, command, connection, use_sudo=False, timeout=10):
+    """ Runs `command` on `host` over a connection of its own, with the user and key_filename given in `connection`
+        rather than Fabric's process-global env, so it is safe in executor threads. Blocks until the command is done.
+        Returns (output, error); error is set if the host could not be reached. """
+    import paramiko
+    client = paramiko.SSHClient()
+    # Workers come and go on reused IPs, so like Fabric's defaults accept unknown host keys
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(host, username=connection.get("user"), key_filename=connection.get("key_filename"),
+                       timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+        stdin, stdout, stderr = client.exec_command(ssh_command(command, use_sudo))
+        stdin.close()
+        output = stdout.read().decode('utf-8', 'replace')
+        stdout.channel.recv_exit_status()
+        return output, None
+    except _retryable_errors() + (OSError,) as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+    finally:
+        client.close()
+
+
+async def run_batch_on_workers(hosts, commands, fabric_defaults, use_sudo=False, stop_on_error=True, parallelism=10):
+    """ Runs `commands` on every host in `hosts`, one connection and one round-trip per host, at most
+        `parallelism` hosts at a time. Returns a dict of host to BatchResult. """
+    marker, script = build_batch_script(commands, stop_on_error)
+    command = batch_command(script)
+    hosts = list(hosts)
+
+    if os.environ.get('AWS_SPAWNER_TEST'):
+        # The bastion helpers only know the host from the environment, so go one worker at a time
+        async def on_host(host):
+            output = await (sudo if use_sudo else run)(command, host_settings={'host_string': host},
+                                                      log_args="batch of %s steps" % len(commands))
+            return (None, "retries exhausted") if output == "RETRY_FAILED" else (output, None)
+        parallelism = 1
+    else:
+        loop = asyncio.get_event_loop()
+        async def on_host(host):
+            # Each host gets its own connection in an executor thread, keeping the event loop free
+            return await loop.run_in_executor(None, ssh_exec, host, command, fabric_defaults, use_sudo)
+
+    semaphore = asyncio.Semaphore(parallelism)
+    async def batch(host):
+        async with semaphore:
+            output, error = await on_host(host)
+        steps = parse_batch_output(commands, marker, output) if error is None else [StepResult(c) for c in commands]
+        return BatchResult(host, steps, error)
+
+    results = await asyncio.gather(*[batch(host) for host in hosts])
+    return dict(zip(hosts, results))
+
 #########################################################################################################
 #########################################################################################################
 
@@ -161,6 +727,123 @@ class InstanceSpawner(Spawner):
             with your log statements, insert a brief sleep into the code where your are logging to allow time for log to
             flush.
         """
+    server_template_url = Unicode(
+        help="S3 URL of the CloudFormation template used to create each user's server stack.",
+    ).tag(config=True)
+
+    @default('server_template_url')
+    def _server_template_url_default(self):
+        return os.environ.get('ServerTemplateUrl', '')
+
+    server_key_name = Unicode(
+        help="Name of the EC2 key pair installed on workers, also used to locate the hub's private key.",
+    ).tag(config=True)
+
+    @default('server_key_name')
+    def _server_key_name_default(self):
+        return os.environ.get('ServerKeyName', '')
+
+    parent_stack = Unicode(
+        help="Name of the CloudFormation stack the worker stacks import their network settings from.",
+    ).tag(config=True)
+
+    @default('parent_stack')
+    def _parent_stack_default(self):
+        return os.environ.get('ParentStack', '')
+
+    region = Unicode(SERVER_PARAMS["REGION"],
+        help="AWS region the worker stacks are created in.",
+    ).tag(config=True)
+
+    template_cache_ttl = Integer(300,
+        help="Seconds the cached server template is reused before checking S3 for a newer version.",
+    ).tag(config=True)
+
+    validate_parameters = Bool(False,
+        help="Check stack parameters against the template before creating a stack, failing bad requests early.",
+    ).tag(config=True)
+
+    instance_id_output = Unicode("InstanceId",
+        help="Stack output holding the worker's EC2 instance ID.",
+    ).tag(config=True)
+
+    instance_ip_output = Unicode("PrivateIp",
+        help="Stack output holding the worker's private IP address.",
+    ).tag(config=True)
+
+    tracking_db_path = Unicode(DB_PATH,
+        help="Path of the SQLite file tracking which server belongs to which user. Opened on first use.",
+    ).tag(config=True)
+
+    node_id = Unicode(
+        help="Identifies this hub process among the processes sharing the tracking database.",
+    ).tag(config=True)
+
+    @default('node_id')
+    def _node_id_default(self):
+        return "%s-%s" % (socket.gethostname(), os.getpid())
+
+    lease_ttl = Integer(3600,
+        help="Seconds a hub process may hold a user's stack while creating or deleting it before others may take over.",
+    ).tag(config=True)
+
+    stack_poll_interval = Integer(15,
+        help="Seconds between status checks while waiting for a stack to be created or deleted.",
+    ).tag(config=True)
+
+    shard_monitor_interval = Integer(300,
+        help="Seconds between passes of the background monitor culling hung workers in this process's shard. 0 disables it, and with it hang culling.",
+    ).tag(config=True)
+
+    batch_parallelism = Integer(10,
+        help="Number of workers run_batch_on_workers, and the shard monitor, talk to at the same time.",
+    ).tag(config=True)
+
+    member_ttl = Integer(60,
+        help="Seconds without a heartbeat after which a hub process no longer gets a share of polling and culling.",
+    ).tag(config=True)
+
+    prespawn_enabled = Bool(False,
+        help="Start workers ahead of logins predicted from each user's spawn history.",
+    ).tag(config=True)
+
+    prespawn_interval = Integer(300,
+        help="Seconds between pre-spawn passes.",
+    ).tag(config=True)
+
+    prespawn_lead_time = Integer(600,
+        help="Seconds ahead of a predicted login to start the worker, roughly how long a stack takes to create.",
+    ).tag(config=True)
+
+    prespawn_window = Integer(1800,
+        help="Length in seconds of the login window predicted on each pass.",
+    ).tag(config=True)
+
+    prespawn_history_days = Integer(28,
+        help="Days of spawn history used to predict logins.",
+    ).tag(config=True)
+
+    prespawn_min_days = Integer(10,
+        help="Predict a login if the user logged in during the same time of day on at least this many days of the history.",
+    ).tag(config=True)
+
+    prespawn_min_weeks = Integer(3,
+        help="Predict a login if the user logged in at the same time on the same weekday in at least this many weeks of the history.",
+    ).tag(config=True)
+
+    prespawn_max_workers = Integer(5,
+        help="Cost cap: the most pre-spawned workers waiting to be claimed at any time, across all hub processes.",
+    ).tag(config=True)
+
+    prespawn_claim_grace = Integer(1800,
+        help="Seconds after the end of the predicted window an unclaimed pre-spawned worker is kept before it is culled.",
+    ).tag(config=True)
+
+    @property
+    def fabric_defaults(self):
+        return {"user": SERVER_PARAMS["WORKER_USERNAME"],
+                "key_filename": "/home/%s/.ssh/%s" % (SERVER_PARAMS["SERVER_USERNAME"], self.server_key_name)}
+
     def set_debug_options(self, dummyUser = None, dummyUserOptions = None, 
                           dummyHubOptions= None, dummyServerOptions = None,
                           dummyApiToken = None, dummyOAuthID = None):
@@ -186,6 +869,7 @@ class InstanceSpawner(Spawner):
             
         self.log.debug("function start for user %s" % self.user.name)
         self.user.last_activity = datetime.utcnow()
+        self.start_background_tasks()
         try:
             instance = self.instance = await self.get_instance() #cannot be a thread pool...
             os.environ['AWS_SPAWNER_WORKER_IP'] = instance.private_ip_address if type(instance.private_ip_address) == str else "NO IP"
@@ -202,6 +886,7 @@ class InstanceSpawner(Spawner):
                 logger.info("start ip and port: %s , %s" % (instance.private_ip_address, NOTEBOOK_SERVER_PORT))
                 self.ip = self.user.server.ip = instance.private_ip_address
                 self.port = self.user.server.port = NOTEBOOK_SERVER_PORT
+                self.record_spawn_event('start')
             elif instance.state["Name"] in ["stopped", "stopping", "pending", "shutting-down"]:
                 # we should tear down the cfn stack here
                 pass
@@ -218,16 +903,24 @@ class InstanceSpawner(Spawner):
                         
             self.log.info("\nCreate new server for user %s \n" % (self.user.name))
 
-            instance = self.instance =  await self.create_new_instance()
+            self.acquire_stack_lease('create')
+            try:
+                instance, ip, adopted = await self.create_new_instance()
+                self.instance = instance
+            finally:
+                self.release_stack_lease()
             self.log.info("Instance created successfully.")
 
-            os.environ['AWS_SPAWNER_WORKER_IP'] = instance.private_ip_address
+            os.environ['AWS_SPAWNER_WORKER_IP'] = ip
             # self.notebook_should_be_running = False
-            self.log.debug("%s , %s" % (instance.private_ip_address, NOTEBOOK_SERVER_PORT))
-            # to reduce chance of 503 or infinite redirect
-            await asyncio.sleep(10)
-            self.ip = self.user.server.ip
+            self.log.debug("%s , %s" % (ip, NOTEBOOK_SERVER_PORT))
+            if not adopted:
+                # to reduce chance of 503 or infinite redirect
+                await asyncio.sleep(10)
+            self.ip = self.user.server.ip = ip
             self.port = self.user.server.port = NOTEBOOK_SERVER_PORT
+            self.record_spawn_event('start')
+            return ip, NOTEBOOK_SERVER_PORT
             
         return instance.private_ip_address, NOTEBOOK_SERVER_PORT
         
@@ -243,21 +936,30 @@ class InstanceSpawner(Spawner):
         
         stackname = f'{self.user.name}-server'
 
-        client = boto3.client("cloudformation", region_name='eu-west-2')
+        client = aws_client("cloudformation", self.region)
+
+        # Raises a 503 if another hub process is creating or deleting the stack, so the server is not
+        # reported as stopped while it keeps running
+        self.acquire_stack_lease('delete')
                 
         try:
             response = client.delete_stack(
                 StackName=stackname,
             )
             
-            waiter = client.get_waiter('stack_delete_complete')
-            await retry(waiter.wait,StackName=stackname)
+            stack = await wait_for_stack(client, stackname, on_poll=lambda: self.renew_stack_lease('delete'),
+                                         delay=self.stack_poll_interval)
+            if stack is not None and stack['StackStatus'] != 'DELETE_COMPLETE':
+                raise web.HTTPError(500, "Stack %s could not be deleted: %s" % (stackname, stack['StackStatus']))
+            self.record_spawn_event('stop')
             
             return 'Notebook stopped'
             # self.notebook_should_be_running = False
         except Server.DoesNotExist:
             self.log.error("Couldn't stop server for user '%s' as it does not exist" % self.user.name)
             # self.notebook_should_be_running = False
+        finally:
+            self.release_stack_lease()
         self.clear_state()
 
     async def terminate(self, now=False, delete_volume=False):
@@ -282,12 +984,9 @@ class InstanceSpawner(Spawner):
 
     # Check if the machine is hanged
     async def check_for_hanged_ec2(self, instance):
-        timerightnow    = datetime.utcnow().replace(tzinfo=None)
-        ec2launchtime   = instance.launch_time.replace(tzinfo=None)
-        ec2uptimeSecond = (timerightnow - ec2launchtime).seconds
         #conn_health = None
         conn_health = ""
-        if ec2uptimeSecond > 180:
+        if instance_uptime(instance) > 180:
             # wait_until_SSHable return : 1) "some object" if SSH is established;  2) "SSH_CONNECTION_FAILED" otherwise
             conn_health  = await self.wait_until_SSHable(instance.private_ip_address,max_retries=5)
         return(conn_health)
@@ -297,6 +996,7 @@ class InstanceSpawner(Spawner):
         """ Polls for whether process is running. If running, return None. If not running,
             return exit code """
         self.log.debug("function poll for user %s" % self.user.name)
+        self.start_background_tasks()
         try:
             instance = await self.get_instance()
             self.log.debug(instance.state)
@@ -305,20 +1005,14 @@ class InstanceSpawner(Spawner):
                 # We cannot have this be a long timeout because Jupyterhub uses poll to determine whether a user can log in.
                 # If this has a long timeout, logging in without notebook running takes a long time.
                 # attempts = 30 if self.notebook_should_be_running else 1
-                # check if the machine is hanged 
-                ec2_run_status = await self.check_for_hanged_ec2(instance)
-                if ec2_run_status == "SSH_CONNECTION_FAILED":
-                    #self.log.debug(ec2_run_status)
-                    await self.kill_instance(instance)
-                    return "Instance Hang"
+                # Hung machines are culled by the ShardMonitor of the process owning the user's shard
+                notebook_running = await self.is_notebook_running(instance.private_ip_address, attempts=1)
+                if notebook_running:
+                    self.log.debug("poll: notebook is running for user %s" % self.user.name)
+                    return None #its up!
                 else:
-                    notebook_running = await self.is_notebook_running(instance.private_ip_address, attempts=1)
-                    if notebook_running:
-                        self.log.debug("poll: notebook is running for user %s" % self.user.name)
-                        return None #its up!
-                    else:
-                        self.log.debug("Poll, notebook is not running for user %s" % self.user.name)
-                        return "server up, no instance running for user %s" % self.user.name
+                    self.log.debug("Poll, notebook is not running for user %s" % self.user.name)
+                    return "server up, no instance running for user %s" % self.user.name
             else:
                 self.log.debug("instance waiting for user %s" % self.user.name)
                 return "instance stopping, stopped, or pending for user %s" % self.user.name
@@ -330,36 +1024,76 @@ class InstanceSpawner(Spawner):
     ################################################################################################################
     ### helpers ###
 
+    def acquire_stack_lease(self, operation):
+        """ Claims the user's stack for this hub process so no other process creates or deletes it at the same time.
+            Raises a 503 if another process holds it. """
+        stackname = f'{self.user.name}-server'
+        init_db(self.tracking_db_path)
+        if not Lease.acquire(stackname, self.node_id, self.lease_ttl, operation):
+            holder = Lease.holder(stackname)
+            self.log.info("Stack %s is held by %s" % (stackname, holder.owner if holder else "another hub process"))
+            raise web.HTTPError(503, "Server for %s is being changed by another hub. Please try again in a few minutes" % self.user.name)
+
+    def renew_stack_lease(self, operation):
+        """ Extends the lease taken by acquire_stack_lease while a long operation is still running. """
+        stackname = f'{self.user.name}-server'
+        if not Lease.acquire(stackname, self.node_id, self.lease_ttl, operation):
+            raise web.HTTPError(503, "Lost the lease on %s to another hub while waiting for it" % stackname)
+
+    def release_stack_lease(self):
+        Lease.release(f'{self.user.name}-server', self.node_id)
+
+    def start_background_tasks(self):
+        """ Starts this hub process's cluster heartbeat, shard monitor and pre-spawner, each once per process. """
+        init_db(self.tracking_db_path)
+        get_membership(self.node_id, self.member_ttl).start()
+        if self.shard_monitor_interval:
+            ensure_shard_monitor(self)
+        if self.prespawn_enabled:
+            ensure_prespawner(self)
+
+    async def run_batch(self, commands, ip_address_string, use_sudo=False, stop_on_error=True):
+        """ Runs a list of shell commands on one worker over a single connection and returns its BatchResult.
+            With stop_on_error the remaining steps are skipped (exit_code None) after the first failing one. """
+        self.log.debug("function run_batch for user %s: %s steps" % (self.user.name, len(commands)))
+        results = await run_batch_on_workers([ip_address_string], commands, self.fabric_defaults,
+                                             use_sudo=use_sudo, stop_on_error=stop_on_error)
+        return results[ip_address_string]
+
+    async def run_batch_on_workers(self, hosts, commands, use_sudo=False, stop_on_error=True):
+        """ Runs a list of shell commands on many workers, batch_parallelism at a time. Returns a dict of host to BatchResult. """
+        self.log.info("Running %s steps on %s workers" % (len(commands), len(hosts)))
+        return await run_batch_on_workers(hosts, commands, self.fabric_defaults, use_sudo=use_sudo,
+                                          stop_on_error=stop_on_error, parallelism=self.batch_parallelism)
+
     async def is_notebook_running(self, ip_address_string, attempts=1):
         """ Checks if jupyterhub/notebook is running on the target machine, returns True if Yes, False if not.
             If an attempts count N is provided the check will be run N times or until the notebook is running, whichever
             comes first. """
-        with settings(**FABRIC_DEFAULTS, host_string=ip_address_string):
-            for i in range(attempts):
-                self.log.info("function check_notebook_running for user %s, attempt %s..." % (self.user.name, i+1))
-                output = await run("ps -ef | grep jupyterhub-singleuser")
-                for line in output.splitlines(): #
-                    #if "jupyterhub-singleuser" and NOTEBOOK_SERVER_PORT in line:
-                    # TODO: Check for notebook command from jhub config 
-                    if "jupyterhub-singleuser" and str(NOTEBOOK_SERVER_PORT)  in str(line):
-                        self.log.info("the following notebook is definitely running:")
-                        self.log.info(line)
-                        return True
-                self.log.info("Notebook for user %s not running..." % self.user.name)
-                await asyncio.sleep(1)
-            self.log.error("Notebook for user %s is not running." % self.user.name)
-            return False
+        host_settings = dict(self.fabric_defaults, host_string=ip_address_string)
+        for i in range(attempts):
+            self.log.info("function check_notebook_running for user %s, attempt %s..." % (self.user.name, i+1))
+            output = await run("ps -ef | grep jupyterhub-singleuser", host_settings=host_settings)
+            for line in output.splitlines(): #
+                #if "jupyterhub-singleuser" and NOTEBOOK_SERVER_PORT in line:
+                # TODO: Check for notebook command from jhub config 
+                if "jupyterhub-singleuser" and str(NOTEBOOK_SERVER_PORT)  in str(line):
+                    self.log.info("the following notebook is definitely running:")
+                    self.log.info(line)
+                    return True
+            self.log.info("Notebook for user %s not running..." % self.user.name)
+            await asyncio.sleep(1)
+        self.log.error("Notebook for user %s is not running." % self.user.name)
+        return False
 
 
     ###  Retun SSH_CONNECTION_FAILED if ssh connection failed
     async def wait_until_SSHable(self, ip_address_string, max_retries=1):
         """ Run a meaningless bash command (a comment) inside a retry statement. """
         self.log.debug("function wait_until_SSHable for user %s" % self.user.name)
-        with settings(**FABRIC_DEFAULTS, host_string=ip_address_string):
-            ret = await run("# waiting for ssh to be connectable for user %s with ip %s and fabric settings %s..." % (self.user.name, ip_address_string, FABRIC_DEFAULTS), max_retries=max_retries)
-        if ret == "RETRY_FAILED":
-           ret = "SSH_CONNECTION_FAILED"
-        return (ret)
+        if await ssh_connectable(ip_address_string, self.fabric_defaults, max_retries=max_retries):
+            return ""
+        return "SSH_CONNECTION_FAILED"
 
 
 
@@ -367,8 +1101,10 @@ class InstanceSpawner(Spawner):
         """ This returns a boto Instance resource; if boto can't find the instance or if no entry for instance in database,
             it raises ServerNotFound error and removes database entry if appropriate """
         logger.info("function get_instance for user %s" % self.user.name)
+        from botocore.exceptions import ClientError
+        init_db(self.tracking_db_path)
         server = Server.get_server(self.user.name)
-        resource = await retry(boto3.resource, "ec2", region_name=SERVER_PARAMS["REGION"])
+        resource = await retry(aws_resource, "ec2", self.region)
         try:
             ret = await retry(resource.Instance, server.server_id)
             logger.info("return for get_instance for user %s: %s" % (self.user.name, ret))
@@ -386,37 +1122,72 @@ class InstanceSpawner(Spawner):
             raise e
             
         
+    def worker_stacks(self):
+        return WorkerStacks.from_config(self)
+
     async def create_new_instance(self):
-        """ Creates and boots a new server to host the worker instance."""
+        """ Creates and boots a new server to host the worker instance and returns (instance, ip, adopted).
+            A usable stack that already exists for the user, e.g. one started by the pre-spawner, is adopted instead
+            (adopted is True) and its instance started if it is stopped. A stack still being deleted, or left over
+            from a failed create, is waited for or deleted first. """
         self.log.debug("function create_new_instance %s" % self.user.name)
 
         stackname = f'{self.user.name}-server'
-
-        client = boto3.client("cloudformation", region_name='eu-west-2')
-        client.create_stack(
-                StackName=stackname,
-                TemplateURL=SERVER_TEMPLATE_URL,
-                Parameters=[
-                    {"ParameterKey": "User", "ParameterValue": str(self.user.name)},
-                    {"ParameterKey": "KeyName", "ParameterValue": str(SERVER_KEY_NAME)},
-                    {"ParameterKey": "ParentStack", "ParameterValue": str(PARENT_STACK)},
-                ],
-        )
+        instance_type = (self.user_options or {}).get('INSTANCE_TYPE')
+        stacks = self.worker_stacks()
+        client = aws_client("cloudformation", self.region)
+        renew = lambda: self.renew_stack_lease('create')
+        adopted = False
+        if not await stacks.launch(self.user.name, instance_type):
+            stack = describe_stack(client, stackname)
+            status = stack['StackStatus'] if stack else None
+            if status in ('DELETE_IN_PROGRESS', 'ROLLBACK_COMPLETE'):
+                self.log.info("Stack %s is %s, replacing it" % (stackname, status))
+                if status == 'ROLLBACK_COMPLETE':
+                    client.delete_stack(StackName=stackname)
+                stack = await wait_for_stack(client, stackname, on_poll=renew, delay=self.stack_poll_interval)
+                if stack is not None:
+                    raise web.HTTPError(503, "Old server for %s could not be removed (%s). Please try again in a few minutes"
+                                             % (self.user.name, stack['StackStatus']))
+                status = None
+            if status is None:
+                if not await stacks.launch(self.user.name, instance_type):
+                    raise web.HTTPError(503, "Server for %s is being created elsewhere. Please try again in a few minutes" % self.user.name)
+            elif status in ADOPTABLE_STACK_STATUSES:
+                adopted = True
+                self.log.info("Stack %s already exists (%s), adopting it" % (stackname, status))
+                # Claimed while start() holds the stack lease, so the pre-spawner cannot cull it from under us
+                init_db(self.tracking_db_path)
+                if Prediction.claim(self.user.name):
+                    self.log.info("User %s claimed their pre-spawned server" % self.user.name)
+            else:
+                raise web.HTTPError(503, "Server for %s is in state %s and cannot be used. Please try again in a few minutes"
+                                         % (self.user.name, status))
 
         self.log.info("Waiting for stack creation to finish...")
-        waiter = client.get_waiter('stack_create_complete')
-        await retry(waiter.wait,StackName=stackname)
+        stack = await wait_for_stack(client, stackname, on_poll=renew, delay=self.stack_poll_interval)
+        if stack is None or stack['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+            raise web.HTTPError(503, "Server for %s could not be created (%s). Please try again in a few minutes"
+                                     % (self.user.name, stack['StackStatus'] if stack else 'stack deleted'))
 
         self.log.info("Getting instance information...")
-        response = client.describe_stack_resources(StackName=stackname)
-        instances = [i for i in response['StackResources'] if i['ResourceType']=='AWS::EC2::Instance']
-
-        instance_id = instances[0]['PhysicalResourceId']
+        instance, ip = await stacks.instance(self.user.name, stack)
+        if adopted:
+            await retry(instance.load)
+            if instance.state["Name"] in ["stopped", "stopping"]:
+                self.log.info("Resuming stopped instance %s for user %s" % (instance.id, self.user.name))
+                await retry(instance.wait_until_stopped, max_retries=LONG_RETRY_COUNT)
+                await retry(instance.start)
+                await retry(instance.wait_until_running, max_retries=LONG_RETRY_COUNT)
 
-        ec2 = boto3.resource("ec2", region_name=SERVER_PARAMS["REGION"])
-        instance = await retry(ec2.Instance, instance_id)
+        return instance, ip, adopted
 
-        return instance
+    def record_spawn_event(self, event):
+        """ Adds a start/stop to the history the pre-spawner learns from. Nothing is recorded without prespawn_enabled. """
+        if not self.prespawn_enabled:
+            return
+        init_db(self.tracking_db_path)
+        SpawnEvent.record(self.user.name, event, (self.user_options or {}).get('INSTANCE_TYPE'))
 
 
     def options_from_form(self, formdata):
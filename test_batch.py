@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Used for testing batched remote execution without a worker: the batch command is run
+by the local bash, wrapped the same way Fabric and ssh_exec wrap commands for the remote shell.
+"""
+
+import asyncio
+import subprocess
+import threading
+import time
+
+from fabric.operations import _shell_escape
+from jupyterhub_aws_spawner import spawner
+from jupyterhub_aws_spawner.spawner import build_batch_script, batch_command, parse_batch_output, ssh_command
+
+
+def run_locally(commands, stop_on_error=True):
+    marker, script = build_batch_script(commands, stop_on_error)
+    # Fabric runs commands as /bin/bash -l -c "<escaped command>", do the same
+    wrapped = '/bin/bash -c "%s"' % _shell_escape(batch_command(script))
+    output = subprocess.run(wrapped, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True).stdout
+    return parse_batch_output(commands, marker, output)
+
+
+#%% Multiline output, output without a trailing newline, empty output, stderr
+steps = run_locally(['echo one; echo two', 'printf no-newline', 'true', 'echo oops >&2'])
+assert [s.exit_code for s in steps] == [0, 0, 0, 0], steps
+assert steps[0].output == 'one\ntwo', repr(steps[0].output)
+assert steps[1].output == 'no-newline', repr(steps[1].output)
+assert steps[2].output == '', repr(steps[2].output)
+assert steps[3].output == 'oops', repr(steps[3].output)
+
+#%% stop_on_error skips the remaining steps, without it they all run
+steps = run_locally(['echo first', 'exit 3', 'echo never'])
+assert [s.exit_code for s in steps] == [0, 3, None], steps
+assert not steps[2].ok
+steps = run_locally(['echo first', 'exit 3', 'echo after'], stop_on_error=False)
+assert [s.exit_code for s in steps] == [0, 3, 0], steps
+assert steps[2].output == 'after'
+
+#%% Steps reading stdin see /dev/null and cannot swallow the rest of the script
+steps = run_locally(['echo one', 'cat >/dev/null; echo ate', 'read x; echo "read $? [$x]"', 'echo three'])
+assert [s.exit_code for s in steps] == [0, 0, 0, 0], steps
+assert steps[1].output == 'ate', repr(steps[1].output)
+assert steps[2].output == 'read 1 []', repr(steps[2].output)
+assert steps[3].output == 'three', repr(steps[3].output)
+
+#%% Quotes, $ and backticks reach the worker unchanged, comments do not swallow the step
+steps = run_locally(['x="a b"; echo "$x" \'$HOME\' `echo tick` # comment', 'echo done'])
+assert steps[0].output == 'a b $HOME tick', repr(steps[0].output)
+assert steps[1].output == 'done'
+
+#%% The command line ssh_exec sends runs the batch unchanged
+marker, script = build_batch_script(['x="a b"; echo "$x" `echo tick`', 'read x; echo "read $?"'])
+output = subprocess.run(ssh_command(batch_command(script)), shell=True, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE, universal_newlines=True).stdout
+steps = parse_batch_output(['a', 'b'], marker, output)
+assert [s.output for s in steps] == ['a b tick', 'read 1'], steps
+
+#%% run_batch_on_workers keeps each host's output apart and at most `parallelism` hosts busy
+running = []
+peak = []
+lock = threading.Lock()
+
+def local_exec(host, command, connection, use_sudo=False):
+    with lock:
+        running.append(host)
+        peak.append(len(running))
+    time.sleep(0.1)
+    with lock:
+        running.remove(host)
+    if host == 'unreachable':
+        return None, "NoValidConnectionsError: unable to connect"
+    return subprocess.run('HOST=%s %s' % (host, command), shell=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout, None
+
+spawner.ssh_exec = local_exec
+hosts = ['10.0.0.%s' % i for i in range(8)] + ['unreachable']
+results = asyncio.get_event_loop().run_until_complete(
+    spawner.run_batch_on_workers(hosts, ['echo $HOST'], {}, parallelism=3))
+assert max(peak) == 3, peak
+for host in hosts[:-1]:
+    assert results[host].ok and results[host].steps[0].output == host, results[host]
+assert results['unreachable'].error and results['unreachable'].steps[0].exit_code is None
+
+#%% Concurrent retried commands each run with their own host, even while the other one is sleeping
+from fabric.api import env
+seen = {}
+
+def flaky(name):
+    seen.setdefault(name, []).append(env.host_string)
+    if len(seen[name]) < 3:
+        raise EOFError()
+    return env.host_string
+
+async def both():
+    return await asyncio.gather(*[spawner.retry(spawner._on_host(flaky, {'host_string': host}), host, timeout=0.01)
+                                  for host in ('10.0.0.1', '10.0.0.2')])
+assert asyncio.get_event_loop().run_until_complete(both()) == ['10.0.0.1', '10.0.0.2']
+assert seen == {'10.0.0.1': ['10.0.0.1'] * 3, '10.0.0.2': ['10.0.0.2'] * 3}, seen
+assert env.host_string is None
+
+print("batch script checks passed")
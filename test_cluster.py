@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Used for testing several hub processes sharing one tracking database.
+Runs locally without AWS: every process races for the same stack lease and then
+computes which process owns each user's polling and culling. Finally an idle process
+is checked to stay live through its heartbeat task alone.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import tempfile
+
+from jupyterhub_aws_spawner import models
+from jupyterhub_aws_spawner.cluster import get_membership
+
+PROCESSES = 8
+USERS = ['user%s' % i for i in range(200)]
+
+
+def hub_process(db_path, node_id, barrier, results):
+    models.init_db(db_path)
+    membership = get_membership(node_id, member_ttl=60)
+    membership.refresh(force=True)
+    barrier.wait()
+    won = models.Lease.acquire('developmentUser-server', node_id, ttl=60, operation='create')
+    barrier.wait()
+    # Every member has heartbeated by now, rebuild the ring with all of them
+    membership.refresh(force=True)
+    owners = {user: membership.owner(user) for user in USERS}
+    results.put((node_id, won, owners))
+
+
+if __name__ == '__main__':
+    db_path = os.path.join(tempfile.mkdtemp(), 'server_tracking.sqlite3')
+    barrier = multiprocessing.Barrier(PROCESSES)
+    results = multiprocessing.Queue()
+    nodes = ['hub-%s' % i for i in range(PROCESSES)]
+    processes = [multiprocessing.Process(target=hub_process, args=(db_path, node, barrier, results)) for node in nodes]
+    for p in processes:
+        p.start()
+    outputs = [results.get(timeout=60) for _ in processes]
+    for p in processes:
+        p.join()
+
+    winners = [node for node, won, _ in outputs if won]
+    assert len(winners) == 1, winners
+    print("lease won by %s" % winners[0])
+
+    shards = [owners for _, _, owners in outputs]
+    assert all(owners == shards[0] for owners in shards), "processes disagree on shard owners"
+    counts = {node: list(shards[0].values()).count(node) for node in nodes}
+    assert all(counts.values()), counts
+    print("users per process: %s" % counts)
+
+    # A process that never polls anyone still heartbeats, so the others keep it in the ring
+    models.init_db(db_path)
+    idle = get_membership('idle-hub', member_ttl=1)
+    async def idle_for(seconds):
+        idle.start()
+        await asyncio.sleep(seconds)
+    asyncio.get_event_loop().run_until_complete(idle_for(2.5))
+    assert 'idle-hub' in models.Member.live_nodes(1), models.Member.live_nodes(1)
+    print("idle process kept alive by its heartbeat")
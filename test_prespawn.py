@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Used for testing login prediction and the pre-spawner without AWS. Start history is written
+into a temporary tracking database and the worker stacks are replaced by a recorder.
+"""
+
+import asyncio
+import datetime
+import os
+import tempfile
+
+from tornado import web
+
+from jupyterhub_aws_spawner import models
+from jupyterhub_aws_spawner.models import Lease, SpawnEvent, Prediction
+from jupyterhub_aws_spawner.prespawn import PreSpawner, predict_login
+
+NOW = datetime.datetime(2026, 3, 2, 8, 50) # a Monday
+LEAD = datetime.timedelta(minutes=10)
+WINDOW = datetime.timedelta(minutes=30)
+
+
+class RecordingStacks(object):
+    """ Stands in for WorkerStacks, remembering what the pre-spawner asked for. Users in `failing` raise
+        like a create_stack rejected by validate_parameters. """
+    def __init__(self):
+        self.prespawned = []
+        self.culled = []
+        self.failing = set()
+
+    async def prespawn(self, user_name, instance_type):
+        self.prespawned.append((user_name, instance_type))
+        if user_name in self.failing:
+            raise web.HTTPError(400, "Cannot create server for %s: unknown instance type" % user_name)
+        return 'created'
+
+    async def cull_prespawned(self, user_name, action):
+        self.culled.append((user_name, action))
+        if user_name in self.failing:
+            raise web.HTTPError(503, "Could not stop the worker of %s" % user_name)
+
+
+def daily_starts(days, hour=9, minute=5):
+    return sorted(NOW.replace(hour=hour, minute=minute) - datetime.timedelta(days=d) for d in days)
+
+
+def add_history(user_id, starts, instance_type='', last_event='stop'):
+    for at in starts:
+        SpawnEvent.create(user_id=user_id, event='start', instance_type=instance_type, at=at)
+        SpawnEvent.create(user_id=user_id, event='stop', at=at + datetime.timedelta(hours=1))
+    if last_event == 'start':
+        SpawnEvent.create(user_id=user_id, event='start', at=NOW - datetime.timedelta(minutes=5))
+
+
+def predict(starts, min_days=10, min_weeks=3):
+    return predict_login(starts, NOW, LEAD, WINDOW, 28, min_days, min_weeks)
+
+
+#%% Daily and weekly hits
+assert predict(daily_starts(range(1, 11)))
+assert not predict(daily_starts(range(1, 10))), "9 days is below min_days"
+assert not predict(daily_starts(range(1, 11), hour=11)), "logins at another time of day"
+assert predict(daily_starts([7, 14, 21]))
+assert not predict(daily_starts([7, 14, 20])), "only two hits on this weekday"
+assert not predict(daily_starts([1, 2, 3, 4, 5, 6]), min_days=10), "daily hits off the weekday are not weekly hits"
+
+
+def new_prespawner(max_workers=2):
+    for model in (Lease, SpawnEvent, Prediction):
+        model.delete().execute()
+    stacks = RecordingStacks()
+    prespawner = PreSpawner(stacks, 'hub-0', interval=60, lead_time=LEAD.total_seconds(), window=WINDOW.total_seconds(),
+                            max_workers=max_workers, claim_grace=1800)
+    return prespawner, stacks
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+models.init_db(os.path.join(tempfile.mkdtemp(), 'server_tracking.sqlite3'))
+
+#%% The cap and the "already running" skip
+prespawner, stacks = new_prespawner(max_workers=2)
+add_history('alice', daily_starts(range(1, 15)), instance_type='t3.large')
+add_history('bob', daily_starts(range(1, 15)), last_event='start')
+add_history('carol', daily_starts(range(1, 15)))
+add_history('dave', daily_starts(range(1, 15)))
+add_history('erin', daily_starts(range(1, 4)))
+run(prespawner.tick(NOW))
+assert stacks.prespawned == [('alice', 't3.large'), ('carol', '')], stacks.prespawned
+assert Prediction.count() == 2
+# Nothing new while the cap is taken, not even dave
+run(prespawner.tick(NOW))
+assert len(stacks.prespawned) == 2, stacks.prespawned
+# alice logs in, claiming the worker and recording a start
+assert Prediction.claim('alice')
+SpawnEvent.create(user_id='alice', event='start', at=NOW)
+run(prespawner.tick(NOW))
+assert stacks.prespawned[-1] == ('dave', ''), stacks.prespawned
+assert not stacks.culled
+
+#%% Cull versus claim
+prespawner, stacks = new_prespawner()
+add_history('alice', daily_starts(range(1, 15)))
+add_history('bob', daily_starts(range(1, 15)))
+add_history('carol', daily_starts(range(1, 15)))
+run(prespawner.tick(NOW))
+assert [user for user, _ in stacks.prespawned] == ['alice', 'bob'], stacks.prespawned
+later = NOW + datetime.timedelta(hours=2)
+# alice logged in and claimed the worker, bob's login holds the stack lease right now
+assert Prediction.claim('alice')
+assert Lease.acquire('bob-server', 'hub-1', 3600, 'create')
+run(prespawner.tick(later))
+assert stacks.culled == [], stacks.culled
+assert Prediction.get_or_none(Prediction.user_id == 'bob') is not None
+# bob's login failed without claiming, so the worker is culled once the lease is free
+Lease.release('bob-server', 'hub-1')
+run(prespawner.tick(later))
+assert stacks.culled == [('bob', 'created')], stacks.culled
+assert Prediction.count() == 0
+# The cull counts as a stop, so bob is not taken to be running and is pre-spawned again the next day
+assert SpawnEvent.last_event('bob').event == 'stop'
+
+#%% A user failing to pre-spawn does not block the others and is backed off
+prespawner, stacks = new_prespawner(max_workers=5)
+for user in ('alice', 'bob', 'carol'):
+    add_history(user, daily_starts(range(1, 15)))
+stacks.failing.add('alice')
+for _ in range(3):
+    run(prespawner.tick(NOW))
+assert stacks.prespawned == [('alice', ''), ('bob', ''), ('carol', '')], stacks.prespawned
+assert Prediction.get_or_none(Prediction.user_id == 'alice') is None
+# Tried again once the backoff of 2 * interval is over, still inside the predicted window
+stacks.failing.clear()
+run(prespawner.tick(NOW + datetime.timedelta(minutes=3)))
+assert stacks.prespawned[-1] == ('alice', ''), stacks.prespawned
+assert Prediction.count() == 3
+
+#%% A failed cull keeps the prediction and is retried, without stopping the other culls
+stacks.failing.add('bob')
+later = NOW + datetime.timedelta(hours=2)
+run(prespawner.tick(later))
+assert sorted(stacks.culled) == [('alice', 'created'), ('bob', 'created'), ('carol', 'created')], stacks.culled
+assert [p.user_id for p in Prediction.select()] == ['bob']
+stacks.failing.clear()
+run(prespawner.tick(later))
+assert Prediction.count() == 0
+
+#%% Events older than the history are pruned
+prespawner, stacks = new_prespawner()
+add_history('alice', daily_starts([2, 40]))
+run(prespawner.tick(NOW))
+assert SpawnEvent.select().where(SpawnEvent.user_id == 'alice').count() == 2
+
+print("pre-spawn checks passed")